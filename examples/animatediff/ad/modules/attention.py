@@ -19,7 +19,6 @@ import numpy as np
 
 import mindspore as ms
 from mindspore import nn, ops
-from mindspore.common.initializer import initializer
 
 from mindone.utils.version_control import check_valid_flash_attention, choose_flash_attention_dtype, is_old_ms_version
 
@@ -31,6 +30,17 @@ if FLASH_IS_AVAILABLE:
 
     logger.info("Flash attention is available.")
 
+# newer MindSpore exposes flash attention as an operator that supports the
+# transpose-free "BSND"/"BNSD" input layouts
+FA_SCORE_IS_AVAILABLE = FLASH_IS_AVAILABLE and hasattr(ops, "flash_attention_score")
+
+
+def _jit_if_available(fn):
+    # ms.jit only exists from MindSpore 2.0, and this module still supports
+    # the pre-2.0 line (see is_old_ms_version); decorators run at class
+    # definition, so an unconditional ms.jit would break import there
+    return ms.jit(fn) if hasattr(ms, "jit") else fn
+
 
 def exists(val):
     return val is not None
@@ -52,13 +62,14 @@ class GEGLU(nn.Cell):
     def __init__(self, dim_in, dim_out, dtype=ms.float32):
         super().__init__()
         self.proj = nn.Dense(dim_in, dim_out * 2).to_float(dtype)
-        self.split = ops.Split(-1, 2)
+        self.dim_out = dim_out
         self.gelu = ops.GeLU()
 
     def construct(self, x):
-        x, gate = self.split(self.proj(x))
-
-        return x * self.gelu(gate)
+        x = self.proj(x)
+        # slice views instead of a materializing Split, so the graph compiler
+        # can fuse slice + GeLU + mul into one pass over the projection output
+        return x[..., : self.dim_out] * self.gelu(x[..., self.dim_out :])
 
 
 class FeedForward(nn.Cell):
@@ -85,15 +96,20 @@ def zero_module(module):
     """
     Zero out the parameters of a module and return it.
     """
-    weight = initializer("zeros", module.weight.shape)
-    bias_weight = initializer("zeros", module.bias.shape)
-    module.weight.set_data(weight)
-    module.bias.set_data(bias_weight)
+    module.weight.set_data(ops.zeros(module.weight.shape, module.weight.dtype))
+    module.bias.set_data(ops.zeros(module.bias.shape, module.bias.dtype))
     return module
 
 
-def Normalize(in_channels):
-    return nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True).to_float(ms.float32)
+def Normalize(in_channels, dtype=ms.float32):
+    # bf16 shares fp32's exponent range, so GroupNorm can stay in bf16 and skip
+    # the up-cast/down-cast round-trip; fp16 mean/variance accumulation over
+    # 32 x H x W elements can overflow, so those modules keep the fp32 pin
+    if dtype == getattr(ms, "bfloat16", None):
+        norm_dtype = dtype
+    else:
+        norm_dtype = ms.float32
+    return nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True).to_float(norm_dtype)
 
 
 class LinearAttention(nn.Cell):
@@ -127,53 +143,42 @@ class CrossAttention(nn.Cell):
 
         self.heads = heads
 
-        self.transpose = ops.Transpose()
-        self.to_q = nn.Dense(query_dim, inner_dim, has_bias=False).to_float(dtype)
-        self.to_k = nn.Dense(context_dim, inner_dim, has_bias=False).to_float(dtype)
-        self.to_v = nn.Dense(context_dim, inner_dim, has_bias=False).to_float(dtype)
+        self.enable_flash_attention = (
+            enable_flash_attention and FLASH_IS_AVAILABLE and (ms.context.get_context("device_target") == "Ascend")
+        )
+        self.use_fa_score = self.enable_flash_attention and FA_SCORE_IS_AVAILABLE
+        # FA kernels consume fp16, so let the projections emit it directly
+        # instead of re-casting the full Q/K/V tensors on every call
+        self.attn_dtype = ms.float16 if self.enable_flash_attention else dtype
+
+        self.to_q = nn.Dense(query_dim, inner_dim, has_bias=False).to_float(self.attn_dtype)
+        self.to_k = nn.Dense(context_dim, inner_dim, has_bias=False).to_float(self.attn_dtype)
+        self.to_v = nn.Dense(context_dim, inner_dim, has_bias=False).to_float(self.attn_dtype)
         self.to_out = nn.SequentialCell(
             nn.Dense(inner_dim, query_dim).to_float(dtype),
             nn.Dropout(dropout) if is_old_ms_version() else nn.Dropout(p=1 - dropout),
         )
         self.head_dim = dim_head
-        self.attention = Attention(dim_head)
-
-        self.enable_flash_attention = (
-            enable_flash_attention and FLASH_IS_AVAILABLE and (ms.context.get_context("device_target") == "Ascend")
-        )
+        self.scale = dim_head**-0.5
+        self.attention = Attention(dim_head, enable_flash_attention=self.enable_flash_attention)
 
         if self.enable_flash_attention:
-            self.flash_attention = FlashAttention(
-                head_dim=dim_head, head_num=heads, high_precision=True
-            )  # TODO: how high_precision affect the training or inference quality
+            if self.use_fa_score:
+                self.flash_attention = None  # ops.flash_attention_score consumes (b, n, h, d) directly
+            else:
+                self.flash_attention = FlashAttention(
+                    head_dim=dim_head, head_num=heads, high_precision=True
+                )  # TODO: how high_precision affect the training or inference quality
             self.fa_mask_dtype = choose_flash_attention_dtype()  # ms.uint8 or ms.float16 depending on version
             # logger.info("Flash attention is enabled.")
         else:
             self.flash_attention = None
 
-    @staticmethod
-    def _rearange_in(x, h):
-        # (b, n, h*d) -> (b*h, n, d)
-        b, n, d = x.shape
-        d = d // h
-
-        x = ops.reshape(x, (b, n, h, d))
-        x = ops.transpose(x, (0, 2, 1, 3))
-        x = ops.reshape(x, (b * h, n, d))
-        return x
-
-    @staticmethod
-    def _rearange_out(x, h):
-        # (b*h, n, d) -> (b, n, h*d)
-        b, n, d = x.shape
-        b = b // h
-
-        x = ops.reshape(x, (b, h, n, d))
-        x = ops.transpose(x, (0, 2, 1, 3))
-        x = ops.reshape(x, (b, n, h * d))
-        return x
-
+    @_jit_if_available
     def construct(self, x, context=None, mask=None):
+        # ms.jit keeps one compiled graph per input shape/dtype signature, so
+        # each of the UNet's fixed (b, n) shapes per resolution gets its own
+        # shape-specialized kernels instead of per-call dynamic shape handling
         x_dtype = x.dtype
         h = self.heads
 
@@ -188,34 +193,56 @@ class CrossAttention(nn.Cell):
 
         head_dim = q.shape[-1] // self.heads
 
+        # (b, n, h*d) -> (b, n, h, d): pure views, no data movement
+        q = q.view(q_b, q_n, h, head_dim)
+        k = k.view(k_b, k_n, h, head_dim)
+        v = v.view(v_b, v_n, h, head_dim)
+
         if (
             self.enable_flash_attention and q_n % 16 == 0 and k_n % 16 == 0 and head_dim <= 128
         ):  # FIXME: now restrict head_dim to 128 to avoid 160 bug. revert to 256 once FA bug is fixed.
-            # reshape qkv shape ((b n h*d) -> (b h n d))and mask dtype for FA input format
-            q = q.view(q_b, q_n, h, -1).transpose(0, 2, 1, 3)
-            k = k.view(k_b, k_n, h, -1).transpose(0, 2, 1, 3)
-            v = v.view(v_b, v_n, h, -1).transpose(0, 2, 1, 3)
-            if mask is None:
-                mask = ops.zeros((q_b, q_n, q_n), self.fa_mask_dtype)
-
-            out = self.flash_attention(
-                q.to(ms.float16), k.to(ms.float16), v.to(ms.float16), mask.to(self.fa_mask_dtype)
-            )
-
-            b, h, n, d = out.shape
-            # reshape FA output to original attn input format, (b h n d) -> (b n h*d)
-            out = out.transpose(0, 2, 1, 3).view(b, n, -1)
+            # an all-zero mask attends everywhere, i.e. it equals no mask at
+            # all - skip the O(b*n^2) zeros allocation and run FA unmasked
+            if self.use_fa_score:
+                # "BSND" consumes the (b, n, h, d) views as is - no transposes;
+                # projections already emit fp16, so no per-call casts either
+                # flash_attention_score only takes bool/uint8 masks; the
+                # fp16 dtype choose_flash_attention_dtype() returns on 2.2.0
+                # applies to the legacy cell only
+                fa_mask = None if mask is None else ops.expand_dims(mask.to(ms.uint8), 1)
+                out = ops.flash_attention_score(
+                    q,
+                    k,
+                    v,
+                    head_num=h,
+                    input_layout="BSND",
+                    scalar_value=self.scale,
+                    attn_mask=fa_mask,
+                )
+                out = out.view(q_b, q_n, -1)
+            else:
+                # legacy FlashAttention cell expects (b, h, n, d)
+                q = q.transpose(0, 2, 1, 3)
+                k = k.transpose(0, 2, 1, 3)
+                v = v.transpose(0, 2, 1, 3)
+                if mask is None:
+                    out = self.flash_attention(q, k, v)
+                else:
+                    out = self.flash_attention(q, k, v, mask.to(self.fa_mask_dtype))
+                out = out.transpose(0, 2, 1, 3).view(q_b, q_n, -1)
         else:
-            # (b, n, h*d) -> (b*h, n, d)
-            q = self._rearange_in(q, h)
-            k = self._rearange_in(k, h)
-            v = self._rearange_in(v, h)
+            # (b, n, h, d) -> (b, h, n, d): one transpose, no (b*h) flattening
+            q = q.transpose(0, 2, 1, 3)
+            k = k.transpose(0, 2, 1, 3)
+            v = v.transpose(0, 2, 1, 3)
 
             out = self.attention(q, k, v, mask)
-            # (b*h, n, d) -> (b, n, h*d)
-            out = self._rearange_out(out, h)
+            # (b, h, n, d) -> (b, n, h*d)
+            out = out.transpose(0, 2, 1, 3).view(q_b, q_n, -1)
 
-        return self.to_out(out).to(x_dtype)
+        out = self.to_out(out)
+        # to_out already emits x_dtype in the common path; only cast on mismatch
+        return out if out.dtype == x_dtype else out.to(x_dtype)
 
 
 class CrossFrameAttention(CrossAttention):
@@ -223,97 +250,150 @@ class CrossFrameAttention(CrossAttention):
         super().__init__(*args, **kwargs)
         self.unet_chunk_size = unet_chunk_size
 
+    @_jit_if_available
     def construct(self, x, context=None, mask=None):
+        # per-shape compiled graphs, same as CrossAttention.construct
+        h = self.heads
+
         q = self.to_q(x)
         is_cross_attention = context is not None
         context = default(context, x)
         k = self.to_k(context)
         v = self.to_v(context)
 
-        def rearange_in(x):
-            # (b, n, h*d) -> (b*h, n, d)
-            h = self.heads
-            b, n, d = x.shape
-            d = d // h
-
-            x = self.reshape(x, (b, n, h, d))
-            x = self.transpose(x, (0, 2, 1, 3))
-            x = self.reshape(x, (b * h, n, d))
-            return x
-
-        def rearange_frame(x, f):
-            b, n, d = x.shape
-            b = b // f
-            x = self.reshape(x, (b, f, n, d))
-            return x
-
-        def rearange_frame_back(x):
-            b, f, n, d = x.shape
-            x = self.reshape(x, (b * f, n, d))
-            return x
-
+        fold_frames = False
         if not is_cross_attention:
             video_length = k.shape[0] // self.unet_chunk_size
-            former_frame_index = [0] * video_length
-            k = rearange_frame(k, video_length)
-            k = k[:, former_frame_index]
-            k = rearange_frame_back(k)
-            v = rearange_frame(v, video_length)
-            v = v[:, former_frame_index]
-            v = rearange_frame_back(v)
-
-        q = rearange_in(q)
-        k = rearange_in(k)
-        v = rearange_in(v)
-
-        if self.enable_flash_attention and q.shape[1] % 16 == 0 and k.shape[1] % 16 == 0:
-            out = self.flash_attention(q, k, v)
+            bf, n, d = k.shape
+            b = bf // video_length
+            if self.use_fa_score and mask is None:
+                # every frame attends only to frame 0 - a structured sparsity
+                # pattern. Softmax is row-wise, so instead of expanding frame-0
+                # K/V across all frames we fold the frame axis into the query
+                # sequence and attend once against the single frame-0 K/V:
+                # (b*f, n) x n attention becomes (b, f*n) x n attention.
+                # flash_attention_score and the dense fallback both accept the
+                # unequal q/k lengths this produces.
+                fold_frames = True
+                q = ops.reshape(q, (b, video_length * n, d))
+                k = ops.reshape(k, (b, video_length, n, d))[:, 0]
+                v = ops.reshape(v, (b, video_length, n, d))[:, 0]
+            else:
+                # the legacy FlashAttention cell has only ever seen equal q/k
+                # lengths, and a caller mask is shaped for the unfolded batch,
+                # so keep frame-0 K/V expanded per frame here - still a
+                # stride-0 broadcast, not a gather
+                k = ops.reshape(k, (b, video_length, n, d))
+                k = ops.broadcast_to(k[:, :1], k.shape)
+                k = ops.reshape(k, (bf, n, d))
+                v = ops.reshape(v, (b, video_length, n, d))
+                v = ops.broadcast_to(v[:, :1], v.shape)
+                v = ops.reshape(v, (bf, n, d))
+
+        q_b, q_n, _ = q.shape
+        k_b, k_n, _ = k.shape
+        v_b, v_n, _ = v.shape
+        head_dim = q.shape[-1] // h
+
+        # (b, n, h*d) -> (b, n, h, d): pure views, no data movement
+        q = q.view(q_b, q_n, h, head_dim)
+        k = k.view(k_b, k_n, h, head_dim)
+        v = v.view(v_b, v_n, h, head_dim)
+
+        if self.enable_flash_attention and q_n % 16 == 0 and k_n % 16 == 0:
+            if self.use_fa_score:
+                # "BSND" consumes the (b, n, h, d) views as is - no transposes
+                out = ops.flash_attention_score(q, k, v, head_num=h, input_layout="BSND", scalar_value=self.scale)
+                out = out.view(q_b, q_n, -1)
+            else:
+                # legacy FlashAttention cell expects (b, h, n, d)
+                q = q.transpose(0, 2, 1, 3)
+                k = k.transpose(0, 2, 1, 3)
+                v = v.transpose(0, 2, 1, 3)
+                out = self.flash_attention(q, k, v)
+                out = out.transpose(0, 2, 1, 3).view(q_b, q_n, -1)
         else:
-            # TODO: avoid construct another cell for it, use scaled_dot_product_attention?
+            # (b, n, h, d) -> (b, h, n, d): one transpose, no (b*h) flattening
+            q = q.transpose(0, 2, 1, 3)
+            k = k.transpose(0, 2, 1, 3)
+            v = v.transpose(0, 2, 1, 3)
             out = self.attention(q, k, v, mask)
+            out = out.transpose(0, 2, 1, 3).view(q_b, q_n, -1)
 
-        def rearange_out(x):
-            # (b*h, n, d) -> (b, n, h*d)
-            h = self.heads
-            b, n, d = x.shape
-            b = b // h
-
-            x = self.reshape(x, (b, h, n, d))
-            x = self.transpose(x, (0, 2, 1, 3))
-            x = self.reshape(x, (b, n, h * d))
-            return x
+        if fold_frames:
+            # unfold the frame axis back out of the query sequence
+            out = ops.reshape(out, (x.shape[0], x.shape[1], -1))
 
-        out = rearange_out(out)
         return self.to_out(out)
 
 
+@_jit_if_available
+def _masked_softmax(sim, mask, max_neg_value):
+    # fused in one compiled region so the (n, n) sim tensor is not re-read
+    # between mask expansion, fill and softmax
+    # (b, k_n) key-padding mask broadcasts over the head and query dims
+    mask = ops.reshape(mask, (mask.shape[0], 1, 1, -1))
+    sim = sim.masked_fill(mask, max_neg_value)
+    return ops.softmax(sim, axis=-1)
+
+
 class Attention(nn.Cell):
-    def __init__(self, dim_head):
+    def __init__(self, dim_head, enable_flash_attention=False):
         super().__init__()
         self.softmax = ops.Softmax(axis=-1)
-        self.transpose = ops.Transpose()
+        # transpose_b lets the GEMM read K in its native layout instead of
+        # materializing a permuted copy first
+        self.bmm_qk = ops.BatchMatMul(transpose_b=True)
+        self.bmm = ops.BatchMatMul()
         self.scale = dim_head**-0.5
+        self.head_dim = dim_head
+        # most-negative representable values, hoisted so the mask path does
+        # not round-trip through numpy on every call
+        self.max_neg_fp16 = ms.Tensor(-np.finfo(np.float16).max, ms.float16)
+        self.max_neg_fp32 = ms.Tensor(-np.finfo(np.float32).max, ms.float32)
+        # the fused kernel computes softmax(QK^T)V in on-chip tiles without
+        # materializing the (n, n) similarity matrix in device memory; it is
+        # opt-in via the owner's enable_flash_attention, never implicit
+        self.use_fused_attention = (
+            enable_flash_attention and FA_SCORE_IS_AVAILABLE and (ms.context.get_context("device_target") == "Ascend")
+        )
 
     def construct(self, q, k, v, mask):
-        sim = ops.matmul(q, self.transpose(k, (0, 2, 1))) * self.scale
+        # q/k/v: (b, h, n, d)
+        q_n, k_n = q.shape[2], k.shape[2]
+        if (
+            self.use_fused_attention
+            and mask is None
+            and q.dtype == ms.float16  # the FA kernel is fp16-only; never downcast fp32 inputs
+            and q_n % 16 == 0
+            and k_n % 16 == 0
+            and self.head_dim <= 128
+        ):
+            out = ops.flash_attention_score(
+                q,
+                k,
+                v,
+                head_num=q.shape[1],
+                input_layout="BNSD",
+                scalar_value=self.scale,
+            )
+            return out
 
-        if exists(mask):
-            mask = self.reshape(mask, (mask.shape[0], -1))
-            if sim.dtype == ms.float16:
-                finfo_type = np.float16
-            else:
-                finfo_type = np.float32
-            max_neg_value = -np.finfo(finfo_type).max
-            mask = mask.repeat(self.heads, axis=0)
-            mask = ops.expand_dims(mask, axis=1)
-            sim.masked_fill(mask, max_neg_value)
+        sim = self.bmm_qk(q, k) * self.scale
 
         # TODO: testing use fp16 instead
         # use fp32 for exponential inside
         # attn = self.softmax(sim.astype(ms.float32)).astype(v.dtype)
-        attn = self.softmax(sim)
+        if exists(mask):
+            if sim.dtype == ms.float16:
+                max_neg_value = self.max_neg_fp16
+            else:
+                max_neg_value = self.max_neg_fp32
+            attn = _masked_softmax(sim, mask, max_neg_value)
+        else:
+            attn = self.softmax(sim)
 
-        out = ops.matmul(attn, v)
+        out = self.bmm(attn, v)
 
         return out
 
@@ -380,9 +460,13 @@ class BasicTransformerBlock(nn.Cell):
         self.norm3 = nn.LayerNorm([dim], epsilon=1e-05).to_float(dtype)
         self.checkpoint = checkpoint
 
+    @_jit_if_available
     def construct(self, x, context=None):
+        # compile the whole norm -> attention -> residual body as one graph so
+        # the backend can fuse it instead of dispatching op-by-op in pynative;
+        # context is passed positionally - jit kwarg support is shaky on 2.2
         x = self.attn1(self.norm1(x)) + x
-        x = self.attn2(self.norm2(x), context=context) + x
+        x = self.attn2(self.norm2(x), context) + x
         x = self.ff(self.norm3(x)) + x
         return x
 
@@ -394,6 +478,10 @@ class SpatialTransformer(nn.Cell):
     and reshape to b, t, d.
     Then apply standard transformer action.
     Finally, reshape to image
+
+    use_linear=True (default) runs proj_in/proj_out as Dense layers on the
+    flattened (b, h*w, c) sequence, so each NCHW boundary costs a single
+    tiled transpose instead of bracketing 1x1 convs with extra permutes.
     """
 
     def __init__(
@@ -405,7 +493,7 @@ class SpatialTransformer(nn.Cell):
         dropout=1.0,
         context_dim=None,
         use_checkpoint=True,
-        use_linear=False,
+        use_linear=True,
         dtype=ms.float32,
         enable_flash_attention=False,
         cross_frame_attention=False,
@@ -415,7 +503,7 @@ class SpatialTransformer(nn.Cell):
         self.in_channels = in_channels
         self.dtype = dtype
         inner_dim = n_heads * d_head
-        self.norm = Normalize(in_channels)
+        self.norm = Normalize(in_channels, dtype=dtype)
 
         if not use_linear:
             self.proj_in = nn.Conv2d(
@@ -424,23 +512,29 @@ class SpatialTransformer(nn.Cell):
         else:
             self.proj_in = nn.Dense(in_channels, inner_dim).to_float(dtype)
 
-        self.transformer_blocks = nn.CellList(
-            [
-                BasicTransformerBlock(
-                    inner_dim,
-                    n_heads,
-                    d_head,
-                    dropout=dropout,
-                    context_dim=context_dim,
-                    checkpoint=use_checkpoint,
-                    dtype=self.dtype,
-                    enable_flash_attention=enable_flash_attention,
-                    cross_frame_attention=cross_frame_attention,
-                    unet_chunk_size=unet_chunk_size,
-                )
-                for d in range(depth)
-            ]
-        )
+        blocks = [
+            BasicTransformerBlock(
+                inner_dim,
+                n_heads,
+                d_head,
+                dropout=dropout,
+                context_dim=context_dim,
+                checkpoint=use_checkpoint,
+                dtype=self.dtype,
+                enable_flash_attention=enable_flash_attention,
+                cross_frame_attention=cross_frame_attention,
+                unet_chunk_size=unet_chunk_size,
+            )
+            for d in range(depth)
+        ]
+        # without cross-attention context the blocks are unary, so run them as
+        # one SequentialCell: the compiler sees the whole stack in a single
+        # graph and can fuse across the residual/norm block boundaries
+        self.blocks_are_sequential = context_dim is None
+        if self.blocks_are_sequential:
+            self.transformer_blocks = nn.SequentialCell(blocks)
+        else:
+            self.transformer_blocks = nn.CellList(blocks)
 
         if not use_linear:
             self.proj_out = zero_module(
@@ -466,8 +560,14 @@ class SpatialTransformer(nn.Cell):
         x = self.transpose(x, (0, 2, 1))  # (b, h*w, c)
         if self.use_linear:
             x = self.proj_in(x)
-        for block in self.transformer_blocks:
-            x = block(x, context=context)
+        # a context_dim=None stack may still legally receive a query-dim
+        # context at runtime, so only take the fused sequential call when no
+        # context is actually passed; SequentialCell supports iteration too
+        if self.blocks_are_sequential and context is None:
+            x = self.transformer_blocks(x)
+        else:
+            for block in self.transformer_blocks:
+                x = block(x, context)
         if self.use_linear:
             x = self.proj_out(x)
         x = self.reshape(x, (b, h, w, c))
@@ -0,0 +1,96 @@
+import sys
+
+import numpy as np
+
+import mindspore as ms
+
+sys.path.append(".")
+from ad.modules.attention import Attention, CrossFrameAttention
+
+ms.set_context(mode=ms.PYNATIVE_MODE)
+
+
+def np_softmax(x, axis=-1):
+    x = x - x.max(axis=axis, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def np_attention(q, k, v, mask=None):
+    # q/k/v: (b, h, n, d); mask: (b, k_n) with True = masked out
+    scale = q.shape[-1] ** -0.5
+    sim = np.matmul(q, k.transpose(0, 1, 3, 2)) * scale
+    if mask is not None:
+        sim = np.where(mask[:, None, None, :], -np.finfo(sim.dtype).max, sim)
+    return np.matmul(np_softmax(sim), v)
+
+
+def measure_error(x, y):
+    ae = np.abs(x - y)
+    return ae.mean(), ae.max()
+
+
+def test_masked_softmax():
+    # the dense fallback must actually apply the key-padding mask
+    np.random.seed(42)
+    b, h, n, d = 2, 4, 17, 8
+    q = np.random.randn(b, h, n, d).astype(np.float32)
+    k = np.random.randn(b, h, n, d).astype(np.float32)
+    v = np.random.randn(b, h, n, d).astype(np.float32)
+    mask = np.random.rand(b, n) > 0.7
+
+    attn = Attention(dim_head=d)
+    out = attn(ms.Tensor(q), ms.Tensor(k), ms.Tensor(v), ms.Tensor(mask)).asnumpy()
+    ref = np_attention(q, k, v, mask)
+    mean_ae, max_ae = measure_error(out, ref)
+    print(f"masked softmax\t{mean_ae}\t{max_ae}")
+    assert max_ae < 1e-5
+
+    out = attn(ms.Tensor(q), ms.Tensor(k), ms.Tensor(v), None).asnumpy()
+    ref = np_attention(q, k, v)
+    mean_ae, max_ae = measure_error(out, ref)
+    print(f"plain softmax\t{mean_ae}\t{max_ae}")
+    assert max_ae < 1e-5
+
+
+def test_cross_frame_attention_frame0():
+    # the broadcast/fold rewrites must match the original gather formulation
+    # (every frame attends to frame 0 of its chunk)
+    np.random.seed(0)
+    chunks, f, n, heads, d = 2, 3, 5, 2, 4
+    dim = heads * d
+    bf = chunks * f
+    x = np.random.randn(bf, n, dim).astype(np.float32)
+
+    cfa = CrossFrameAttention(unet_chunk_size=chunks, query_dim=dim, heads=heads, dim_head=d)
+    cfa.set_train(False)
+    out = cfa(ms.Tensor(x)).asnumpy()
+
+    wq = cfa.to_q.weight.asnumpy()
+    wk = cfa.to_k.weight.asnumpy()
+    wv = cfa.to_v.weight.asnumpy()
+    wo = cfa.to_out[0].weight.asnumpy()
+    bo = cfa.to_out[0].bias.asnumpy()
+
+    q = x @ wq.T
+    k = x @ wk.T
+    v = x @ wv.T
+    k = k.reshape(chunks, f, n, dim)[:, [0] * f].reshape(bf, n, dim)
+    v = v.reshape(chunks, f, n, dim)[:, [0] * f].reshape(bf, n, dim)
+
+    def split_heads(t):
+        b, s, _ = t.shape
+        return t.reshape(b, s, heads, d).transpose(0, 2, 1, 3)
+
+    ref = np_attention(split_heads(q), split_heads(k), split_heads(v))
+    ref = ref.transpose(0, 2, 1, 3).reshape(bf, n, dim)
+    ref = ref @ wo.T + bo
+
+    mean_ae, max_ae = measure_error(out, ref)
+    print(f"cross-frame frame-0\t{mean_ae}\t{max_ae}")
+    assert max_ae < 1e-5
+
+
+if __name__ == "__main__":
+    test_masked_softmax()
+    test_cross_frame_attention_frame0()